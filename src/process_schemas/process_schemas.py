@@ -6,7 +6,9 @@ input and output formats. In particular, it adds a few preprocessor directives:
 
 - $$inherit: reference another schema or a list of schemas to inline into the
   schema being processed, with further dictionary members being deep merged
-  into the inherited schema. Non-dictionary members are replaced.
+  into the inherited schema. Non-dictionary members are replaced. For a list,
+  the schemas are deep merged with each other, with earlier entries taking
+  precedence over later ones.
 
 - $$keep: used alongside $$inherit to specify a list of keys to import.
   If specified, only the members specified are merged and all others discarded.
@@ -39,10 +41,14 @@ Dependencies:
   - conda: `conda install python=3 pyyaml jsonschema markdown python-markdown-math pygments
 
 (python3-importlib-metadata is only necessary for Python 3.8 or older)
+
+Optionally, `pip install orjson` for faster reading of JSON input. Input that
+orjson parses differently from the json module (integers beyond 64 bits, NaN)
+is still read with the json module.
 """
 
-import argparse, io, codecs, os, sys, logging, traceback, pprint, posixpath, re
-from collections import OrderedDict
+import argparse, io, os, sys, logging, traceback, pprint, posixpath, re, functools, copy, itertools
+import concurrent.futures
 import urllib.parse
 import urllib.request
 import json
@@ -54,6 +60,21 @@ except ImportError:  # Python < 3.8, may require, e.g., python3-importlib-metada
 
 supported_input_formats = ['json', 'yaml']
 supported_output_formats = ["json", "yaml", "md", "html"]
+supported_input_exts = frozenset("."+x for x in supported_input_formats)
+
+# String values up to this length are interned by handle_all, since short strings like
+# "string", "integer" or "MUST" are repeated many times across schemas
+intern_max_len = 64
+
+# Splits $$exclude pointers on "/" not preceded by a backslash
+exclude_pointer_re = re.compile(r'(?<!\\)/')
+
+# Runs of this many digits may be integers that do not fit in 64 bits, which orjson
+# would turn into floats; such input is parsed with the json module instead
+json_long_int_re = re.compile(rb'\d{19}')
+
+# Parsed data of sources read via read_data_cached, keyed by (source, input_format)
+read_data_cache = {}
 
 arguments = [
     {
@@ -102,6 +123,12 @@ arguments = [
         'names': ['-o', '--output'],
         'help': 'Write the output to a file',
     },
+    {
+        'names': ['-j', '--jobs'],
+        'help': 'Number of worker processes to use when processing a directory, 0 for the number of CPUs (default: 1)',
+        'type': int,
+        'default': 1
+    },
     {
         'names': ['--remove-null'],
         'help': 'Remove keys if the value is null',
@@ -326,6 +353,18 @@ class ExceptionWrapper(Exception):
             full_message += "\nAdd command line argument -d for a full traceback or one or more -v for higher verbosity."
         super().__init__(full_message)
 
+    def __reduce__(self):
+        # Needed to pass the exception back from process_dir worker processes,
+        # since the default pickling would call __init__ with the wrong arguments
+        return (ExceptionWrapper.restore, (self.messages, self.args))
+
+    @classmethod
+    def restore(cls, messages, args):
+        obj = cls.__new__(cls)
+        obj.messages = messages
+        obj.args = args
+        return obj
+
 def sanity_check_id(iid, bases, source_ext=None, idsource = None):
 
     idprefix = os.path.commonprefix([bases['id'], iid])
@@ -401,13 +440,69 @@ def sanity_check(instance, source, iid, bases, args):
         else:
             raise Exception("Validation: sanity check failed, x-optimade-definition -> kind missing")
 
-def validate(instance, args, bases=None, source=None, schemas={}, schema=None, use_schema_field=False, run_sanity_check=True):
-    import jsonschema
+@functools.lru_cache(maxsize=None)
+def jsonschema_version():
+    """
+    Return the version of the installed jsonschema library as a tuple of ints.
+    """
     try:
-        jsc_ver = tuple(int(x) for x in metadata.version("jsonschema").split('.'))
+        return tuple(int(x) for x in metadata.version("jsonschema").split('.'))
     except Exception:
         logging.warning("Could not determine jsonschema version")
-        jsc_ver = (0, 0, 0)
+        return (0, 0, 0)
+
+def get_validator(schema, schemas):
+    """
+    Return a validator for the given schema, using the given schemas to resolve references.
+
+    Parameters
+    ----------
+    schema : dict
+        The schema to validate against.
+    schemas : dict
+        Dictionary of schemas by $id used to resolve references.
+
+    Returns
+    -------
+    jsonschema validator instance
+    """
+    import jsonschema
+
+    if jsonschema_version() >= (4, 18, 0):
+        # jsonschema 4.18.0 deprectates RefResolver, and from this version and forward
+        # there appear to be issues with using it
+
+        from referencing import Registry
+        from referencing.jsonschema import DRAFT202012
+
+        resources = []
+        for resource_schema in schemas:
+            resources += [(resource_schema, DRAFT202012.create_resource(schemas[resource_schema]))]
+        registry = Registry().with_resources(resources)
+        validator = jsonschema.Draft202012Validator(schema=schema, format_checker=jsonschema.FormatChecker(), registry=registry)
+        validator.check_schema(schema)
+
+    else:
+        # jsonschema ver < 4.18.0 does not support referencing, and uses RefResolver
+        # with the questionable default of resolving chemas over the Internet unless blocked.
+
+        from jsonschema import RefResolver
+        class LocalOnlyRefResolver(RefResolver):
+            def resolve_remote(self, uri):
+                raise Exception("Validation: attempt to fetch remote schema over the internet blocked: "+str(uri))
+        resolver = LocalOnlyRefResolver.from_schema(schema=schema, store=schemas)
+        try:
+            validator_class = jsonschema.Draft202012Validator
+        except AttributeError:
+            logging.warning("JSON Schema Python library is not aware of the Draft202012 standard. It is probably too old (< 4). Will validate using default validator.")
+            validator_class = jsonschema.validators.validator_for(schema)
+        validator = validator_class(schema=schema, format_checker=jsonschema.FormatChecker(), resolver=resolver)
+        validator.check_schema(schema)
+
+    return validator
+
+def validate(instance, args, bases=None, source=None, schemas={}, schema=None, use_schema_field=False, run_sanity_check=True):
+    import jsonschema
 
     if '$schema' in instance:
         schema_id = instance['$schema']
@@ -436,43 +531,10 @@ def validate(instance, args, bases=None, source=None, schemas={}, schema=None, u
         sanity_check(instance, source, iid, bases, args)
 
     try:
-        logging.debug("\n\n** Validating:**\n\n"+pprint.pformat(instance)+"\n\n** Using schema:**\n\n"+pprint.pformat(schema)+"\n\n")
-
-        if jsc_ver >= (4, 18, 0):
-            # jsonschema 4.18.0 deprectates RefResolver, and from this version and forward
-            # there appear to be issues with using it
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("\n\n** Validating:**\n\n"+pprint.pformat(instance)+"\n\n** Using schema:**\n\n"+pprint.pformat(schema)+"\n\n")
 
-            from referencing import Registry
-            from referencing.jsonschema import DRAFT202012
-
-            resources = []
-            for resource_schema in schemas:
-                resources += [(resource_schema, DRAFT202012.create_resource(schemas[resource_schema]))]
-            registry = Registry().with_resources(resources)
-            validator = jsonschema.Draft202012Validator(schema=schema, format_checker=jsonschema.FormatChecker(), registry=registry)
-            validator.check_schema(schema)
-            validator.validate(instance)
-
-        else:
-            # jsonschema ver < 4.18.0 does not support referencing, and uses RefResolver
-            # with the questionable default of resolving chemas over the Internet unless blocked.
-
-            from jsonschema import RefResolver
-            class LocalOnlyRefResolver(RefResolver):
-                def resolve_remote(self, uri):
-                    raise Exception("Validation: attempt to fetch remote schema over the internet blocked: "+str(uri))
-            resolver = LocalOnlyRefResolver.from_schema(schema=schema, store=schemas)
-            validator = None
-            try:
-                validator = jsonschema.Draft202012Validator(schema=schema, format_checker=jsonschema.FormatChecker(), resolver=resolver)
-            except AttributeError:
-                logging.warning("JSON Schema Python library is not aware of the Draft202012 standard. It is probably too old (< 4). Will validate using default validator.")
-
-            if validator is not None:
-                validator.check_schema(schema)
-                validator.validate(instance)
-            else:
-                jsonschema.validate(instance=instance, schema=schema, format_checker=jsonschema.FormatChecker(), resolver=resolver)
+        get_validator(schema, schemas).validate(instance)
 
     except jsonschema.ValidationError as e:
         logging.debug("Schema validation failed, full output:\n"+str(e))
@@ -488,7 +550,73 @@ def validate(instance, args, bases=None, source=None, schemas={}, schema=None, u
         logging.debug("Invalid schema: "+str(e))
         raise Exception("Invalid schema: "+e.message)
 
-def read_data(source, input_format='auto', preserve_order=True, origin=None):
+@functools.lru_cache(maxsize=None)
+def yaml_safe_loader():
+    """
+    Return the libyaml-based safe YAML loader if available, otherwise the pure Python one.
+
+    A warning is logged the first time the pure Python loader has to be used.
+    """
+    import yaml
+    try:
+        from yaml import CSafeLoader
+        return CSafeLoader
+    except ImportError:
+        logging.warning("PyYAML is not built with libyaml support, falling back to the slower pure Python YAML loader")
+        return yaml.SafeLoader
+
+@functools.lru_cache(maxsize=None)
+def orjson_loads():
+    """
+    Return orjson.loads if orjson is available, otherwise None.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson.loads
+
+def json_loads(body):
+    """
+    Parse JSON from bytes, using orjson when available and the json module otherwise.
+
+    Input orjson does not parse the same way as the json module (integers beyond
+    64 bits, NaN and Infinity) is parsed with the json module.
+    """
+    loads = orjson_loads()
+    if loads is None or json_long_int_re.search(body) is not None:
+        return json.loads(body)
+    try:
+        return loads(body)
+    except ValueError:
+        # orjson.JSONDecodeError is a subclass of ValueError; let the json module
+        # either accept the input (e.g., NaN) or raise its usual error
+        return json.loads(body)
+
+@functools.lru_cache(maxsize=None)
+def yaml_safe_dumper():
+    """
+    Return the libyaml-based safe YAML dumper if available, otherwise the pure Python one.
+
+    The dumper never emits anchors and aliases, so subtrees shared in the data
+    (e.g., from anchors in YAML input) are written out in full.
+
+    A warning is logged the first time the pure Python dumper has to be used.
+    """
+    import yaml
+    try:
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        logging.warning("PyYAML is not built with libyaml support, falling back to the slower pure Python YAML dumper")
+        SafeDumper = yaml.SafeDumper
+
+    class NoAliasSafeDumper(SafeDumper):
+        def ignore_aliases(self, data):
+            return True
+
+    return NoAliasSafeDumper
+
+def read_data(source, input_format='auto', origin=None):
     """
     Reads data from a file or a URL and returns the parsed content.
 
@@ -507,52 +635,53 @@ def read_data(source, input_format='auto', preserve_order=True, origin=None):
 
     logging.debug("Read data from: %s",source)
 
-    reader = None
     try:
+        # The whole input is read as bytes in one go and parsed from memory;
+        # both parsers handle the (UTF-8) decoding themselves
         parsed_url = urllib.parse.urlparse(source)
         if parsed_url.scheme in ['http', 'https', 'ftp']:
-            resource = urllib.request.urlopen(source)
-            charset = resource.headers.get_content_charset()
-            reader = codecs.getreader(charset)(resource)
-            if input_format == 'auto':
-                if resource.headers.get_content_maintype() in ['application', 'text']:
-                    input_format = resource.headers.get_content_subtype()
-                    if input_format.startswith('x-'):
-                       input_format = input_format[2:]
+            with urllib.request.urlopen(source) as resource:
+                if input_format == 'auto':
+                    if resource.headers.get_content_maintype() in ['application', 'text']:
+                        input_format = resource.headers.get_content_subtype()
+                        if input_format.startswith('x-'):
+                           input_format = input_format[2:]
+                body = resource.read()
         else:
             base, orig_ext = os.path.splitext(parsed_url.path)
             if os.path.isabs(base):
                 base = os.path.join('.',os.path.relpath(base,'/'))
-            for ext in [orig_ext] + ["."+x for x in supported_input_formats]:
-                logging.debug("Checking for file: %s",base+ext)
-                if os.path.isfile(base+ext):
-                    reader = open(base+ext, 'r')
+            body = None
+            if orig_ext in supported_input_exts:
+                # In the common case the source has a supported extension and exists,
+                # so try to open it directly before probing for other files
+                try:
+                    with open(base+orig_ext, 'rb') as reader:
+                        body = reader.read()
                     if input_format == 'auto':
-                        input_format = ext.lstrip(".")
-                    break
-            else:
-                # meant to raise a proper FileNotFoundError
-                reader = open(base+orig_ext, 'r')
+                        input_format = orig_ext.lstrip(".")
+                except (FileNotFoundError, IsADirectoryError):
+                    pass
+            if body is None:
+                for ext in [orig_ext] + ["."+x for x in supported_input_formats]:
+                    logging.debug("Checking for file: %s",base+ext)
+                    if os.path.isfile(base+ext):
+                        path = base+ext
+                        if input_format == 'auto':
+                            input_format = ext.lstrip(".")
+                        break
+                else:
+                    # meant to raise a proper FileNotFoundError
+                    path = base+orig_ext
+                with open(path, 'rb') as reader:
+                    body = reader.read()
 
         if input_format == "yaml":
             import yaml
-            if preserve_order:
-                class YamlOrderedSafeLoader(yaml.SafeLoader):
-                    def __init__(self, stream, object_pairs_hook=OrderedDict):
-                        super().__init__(stream)
-                        def mapper(loader, node):
-                            loader.flatten_mapping(node)
-                            return object_pairs_hook(loader.construct_pairs(node))
-                        self.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, mapper)
-                return yaml.load(reader, YamlOrderedSafeLoader), "yaml"
-            else:
-                return yaml.safe_load(reader), "yaml"
+            return yaml.load(body, Loader=yaml_safe_loader()), "yaml"
 
         if input_format == "json":
-            if preserve_order:
-                return json.load(reader, object_pairs_hook=OrderedDict), "json"
-            else:
-                return json.load(reader), "json"
+            return json_loads(body), "json"
         else:
             raise Exception("Unknown input format or unable to automatically detect for: "+source+", input_format: "+str(input_format))
     except Exception as e:
@@ -561,9 +690,20 @@ def read_data(source, input_format='auto', preserve_order=True, origin=None):
         else:
             raise ExceptionWrapper("When processing source: " +str(origin)+ " couldn't load data from: "+str(source),e)
 
-    finally:
-        if reader is not None:
-            reader.close()
+def read_data_cached(source, input_format='auto', origin=None):
+    """
+    Same as read_data, but only reads and parses each source once.
+
+    The returned data is shared between all callers asking for the same source
+    and thus must not be modified; make a deep copy first if needed.
+    """
+    if urllib.parse.urlparse(source).scheme in ['http', 'https', 'ftp']:
+        key = (source, input_format)
+    else:
+        key = (os.path.abspath(source), input_format)
+    if key not in read_data_cache:
+        read_data_cache[key] = read_data(source, input_format, origin=origin)
+    return read_data_cache[key]
 
 
 def md_header(s, level, style="display"):
@@ -915,21 +1055,30 @@ def data_to_md(data, args, level=0, linksuffix=""):
     if args.index:
         return data_to_md_index(data, args, level=level, linksuffix=linksuffix)
 
-    s = ""
+    parts = []
+    data_to_md_parts(data, args, parts, level=level, linksuffix=linksuffix)
+    return "".join(parts)
+
+def data_to_md_parts(data, args, parts, level=0, linksuffix=""):
+    """
+    Same as data_to_md (without index support), but appends the markdown output
+    in pieces to the list parts, to avoid repeated concatenation of long strings.
+    """
     if not "x-optimade-definition" in data:
         if '$schema' in data and data['$schema'] == 'https://json-schema.org/draft/2020-12/schema':
-            s += schema_to_md(data, args, linksuffix=linksuffix)
-            return s
+            parts.append(schema_to_md(data, args, linksuffix=linksuffix))
+            return
         if 'title' in data:
             basics = data_get_basics(data)
-            s += md_header(basics['title'], level, style="display")
-            s += general_to_md(data, args, linksuffix=linksuffix)
-            return s
+            parts.append(md_header(basics['title'], level, style="display"))
+            parts.append(general_to_md(data, args, linksuffix=linksuffix))
+            return
         for item in sorted(data.keys()):
+            value = data[item]
             try:
-                if isinstance(data[item], dict):
-                    s += md_header(item, level, style="display")
-                    s += data_to_md(data[item], args, level=level+1, linksuffix=linksuffix)
+                if isinstance(value, dict):
+                    parts.append(md_header(item, level, style="display"))
+                    data_to_md_parts(value, args, parts, level=level+1, linksuffix=linksuffix)
                 #elif item == "$id":
                 #    continue
                 #else:
@@ -937,26 +1086,28 @@ def data_to_md(data, args, level=0, linksuffix=""):
                 #    exit(0)
             except Exception as e:
                 raise ExceptionWrapper("Could not process item: "+item,e)
-            s += "\n"
-        return s
+            parts.append("\n")
+        return
 
     if not "kind" in data['x-optimade-definition']:
         raise Exception("x-optimade-definition encountered without a 'kind' field.")
     kind = data['x-optimade-definition']['kind']
 
     if kind == 'property':
-        s += property_definition_to_md(data, args, level, linksuffix=linksuffix)
+        parts.append(property_definition_to_md(data, args, level, linksuffix=linksuffix))
     elif kind in ['unit', 'constant', 'prefix']:
-        s += single_definition_to_md(data, args, level, linksuffix=linksuffix)
+        parts.append(single_definition_to_md(data, args, level, linksuffix=linksuffix))
     elif kind in ['standard', 'entrytype', 'unitsystem']:
-        s += set_definition_to_md(data, args, level, linksuffix=linksuffix)
+        parts.append(set_definition_to_md(data, args, level, linksuffix=linksuffix))
     else:
         raise Exception("Unknown kind in x-optimade-definition: "+str(data['x-optimade-definition']['kind']))
 
-    return s
-
 def data_to_md_index(data, args, path=[], level=0, linksuffix=""):
-    s = ""
+    parts = []
+    data_to_md_index_parts(data, args, parts, path=path, level=level, linksuffix=linksuffix)
+    return "".join(parts)
+
+def data_to_md_index_parts(data, args, parts, path=[], level=0, linksuffix=""):
     # The heuristic of looking for a 'title' field that is a string
     # to determine how to print things is not foolproof,
     # but seems to work for now. This may need revisiting later.
@@ -965,34 +1116,35 @@ def data_to_md_index(data, args, path=[], level=0, linksuffix=""):
         title = basics['title']
         kind = basics['kind']
         if '$id' in data:
-            s += md_header("**["+title+"]("+("/".join(path))+linksuffix+")** ("+kind+") - [`"+data['$id']+"`]("+data['$id']+linksuffix+")",level=level,style="list")
-            s += md_format_lines("\n"+basics['description_short'],level=level+1,style="list")
+            parts.append(md_header("**["+title+"]("+("/".join(path))+linksuffix+")** ("+kind+") - [`"+data['$id']+"`]("+data['$id']+linksuffix+")",level=level,style="list"))
+            parts.append(md_format_lines("\n"+basics['description_short'],level=level+1,style="list"))
         else:
-            s += md_header("**["+title+"]("+("/".join(path))+linksuffix+")** ("+kind+")",level=level,style="list")
-            s += md_format_lines("\n"+basics['description_short'],level=level+1, style="list")
-        s += "\n"
+            parts.append(md_header("**["+title+"]("+("/".join(path))+linksuffix+")** ("+kind+")",level=level,style="list"))
+            parts.append(md_format_lines("\n"+basics['description_short'],level=level+1, style="list"))
+        parts.append("\n")
     else:
         if len(path) > 0:
-            s += md_header("**"+path[-1]+"**", level, style="list")
+            parts.append(md_header("**"+path[-1]+"**", level, style="list"))
             next_level = level + 1
         else:
-            s += md_header("Index", level, style="header")
+            parts.append(md_header("Index", level, style="header"))
             next_level = 0
-        for item in sorted(data.keys()):
+        items = sorted(data.keys())
+        for item in items:
+            value = data[item]
             try:
-                if isinstance(data[item], dict) and ('title' in data[item] and isinstance(data[item]['title'],str)):
-                    s += data_to_md_index(data[item], args, path=path+[str(item)], level=next_level, linksuffix=linksuffix)
+                if isinstance(value, dict) and ('title' in value and isinstance(value['title'],str)):
+                    data_to_md_index_parts(value, args, parts, path=path+[str(item)], level=next_level, linksuffix=linksuffix)
             except Exception as e:
                 raise ExceptionWrapper("Could not process item: "+item,e)
-        for item in sorted(data.keys()):
+        for item in items:
+            value = data[item]
             try:
-                if isinstance(data[item], dict) and not ('title' in data[item] and isinstance(data[item]['title'],str)):
-                    s += data_to_md_index(data[item], args, path=path+[str(item)], level=next_level, linksuffix=linksuffix)
+                if isinstance(value, dict) and not ('title' in value and isinstance(value['title'],str)):
+                    data_to_md_index_parts(value, args, parts, path=path+[str(item)], level=next_level, linksuffix=linksuffix)
             except Exception as e:
                 raise ExceptionWrapper("Could not process item: "+item,e)
 
-    return s
-
 
 def data_to_html(data, args, header=""):
 
@@ -1058,7 +1210,7 @@ def output_str(data, output_format, args):
 
     elif output_format == "yaml":
         import yaml
-        return json.dumps({ k if k != '$$schema' else '$schema': v if k != '$$schema' else v + ".yaml" for k, v in data.items() }, indent=4)
+        return yaml.dump({ k if k != '$$schema' else '$schema': v if k != '$$schema' else v + ".yaml" for k, v in data.items() }, Dumper=yaml_safe_dumper(), sort_keys=False)
 
     elif output_format == "md":
         return data_to_md(data, args, linksuffix=".md")
@@ -1069,6 +1221,33 @@ def output_str(data, output_format, args):
     else:
         raise Exception("Unknown output format: "+str(output_format))
 
+def write_output(data, output_format, args, f):
+    """
+    Serializes key-value data using the specified output format and writes it to a file.
+
+    JSON and YAML output is streamed to the file rather than first built as a
+    string in memory; other formats are written via output_str.
+
+    Parameters
+    ----------
+    data : dict
+        The data to be written in the specified output format.
+    output_format : str
+        The format of the output.
+    f : file-like object
+        Text stream to write the output to.
+    """
+
+    if output_format == "json":
+        json.dump( { k if k != '$$schema' else '$schema': v if k != '$$schema' else v + ".json" for k, v in data.items() }, f, indent=4)
+
+    elif output_format == "yaml":
+        import yaml
+        yaml.dump({ k if k != '$$schema' else '$schema': v if k != '$$schema' else v + ".yaml" for k, v in data.items() }, f, Dumper=yaml_safe_dumper(), sort_keys=False)
+
+    else:
+        f.write(output_str(data, output_format, args))
+
 
 def inherit_to_source(ref, reldir, absdirs, formats):
     """
@@ -1120,6 +1299,35 @@ def inherit_to_source(ref, reldir, absdirs, formats):
     raise Exception("File not found when dereferencing $$inherit: "+str(ref)+" looked in: "+str(checkdirs))
 
 
+class Substitutions:
+    """
+    A callable that performs a set of substring substitutions on a string.
+
+    All substitutions are made in a single pass over the string using one
+    precompiled regular expression. Where keys overlap, the longest one wins.
+    """
+    def __init__(self, subs):
+        """
+        Initialize the Substitutions instance.
+
+        Parameters
+        ----------
+        subs : dict
+            Dictionary mapping each substring to replace to its replacement.
+        """
+        self.subs = subs
+        self.pattern = re.compile("|".join(re.escape(k) for k in sorted(subs, key=len, reverse=True)))
+
+    def __call__(self, s):
+        return self.pattern.sub(self.replacement, s)
+
+    def replacement(self, match):
+        return self.subs[match.group(0)]
+
+    def __repr__(self):
+        return "Substitutions("+repr(self.subs)+")"
+
+
 def recursive_replace(d, subs):
     """
     Recursively replace substrings in values of nested dictionaries that are strings.
@@ -1128,27 +1336,42 @@ def recursive_replace(d, subs):
     ----------
     d : dict
         The dictionary of strings to perform the replacements on.
-    subs : list of tuple
-        The list of key-value pairs to use for replacement. Each tuple contains
-        two elements: the substring to replace and the string to replace it with.
+    subs : Substitutions
+        The substitutions to perform.
 
     Returns
     -------
     dict
         A dictionary with the specified replacements.
     """
-    logging.debug("Substuting strings: %s", subs)
-
     for key, val in d.items():
         if isinstance(val,str):
-            for lhs,rhs in subs.items():
-                val = val.replace(lhs,rhs)
-            d[key] = val
-        if isinstance(val,dict):
+            d[key] = subs(val)
+        elif isinstance(val,dict):
             recursive_replace(val, subs)
     return d
 
 
+def recursive_replace_copy(d, subs):
+    """
+    Same as recursive_replace, but leaves the input unmodified and returns a copy.
+
+    The replacement is done while copying the data, so that it takes a single
+    pass over the data. This allows it to be used directly on shared cached data.
+    """
+    out = {}
+    for key, val in d.items():
+        if isinstance(val,str):
+            out[key] = subs(val)
+        elif isinstance(val,dict):
+            out[key] = recursive_replace_copy(val, subs)
+        elif isinstance(val,list):
+            out[key] = copy.deepcopy(val)
+        else:
+            out[key] = val
+    return out
+
+
 def handle_inherit(ref, mode, bases, subs, args, origin=None):
     """
     Handle a single inheritance.
@@ -1164,8 +1387,8 @@ def handle_inherit(ref, mode, bases, subs, args, origin=None):
         A dictionary containing information about the base paths to use when
         converting the reference to a source path. Must contain the keys "id",
         "self", and "dir".
-    subs: dict
-        dictionary of substitutions to make in strings.
+    subs: Substitutions
+        substitutions to make in strings, or None.
 
     Returns
     -------
@@ -1184,11 +1407,12 @@ def handle_inherit(ref, mode, bases, subs, args, origin=None):
         return { "$ref": base + '.' + args.input_format }
     elif mode == "insert":
         source = inherit_to_source(ref, bases['self'], args.resolve_path, supported_input_formats)
-        data = read_data(source, args.input_format, origin=origin)[0]
+        # The cached data is shared, so it must be copied before it is modified
+        data = read_data_cached(source, args.input_format, origin=origin)[0]
         if subs is not None:
-            return recursive_replace(data, subs)
+            return recursive_replace_copy(data, subs)
         else:
-            return data
+            return copy.deepcopy(data)
     else:
         raise Exception("Internal error: unexpected inherit-mode: "+str(inherit_mode))
 
@@ -1206,17 +1430,102 @@ def merge_deep(d, other, replace=True):
     replace : bool
         Replace items already in d
     """
-    for other_key, other_val in other.items():
-        val = d.get(other_key)
-        if isinstance(val, dict) and isinstance(other_val, dict):
-            merge_deep(val, other_val, replace)
-        elif replace or (other_key not in d):
-            d[other_key] = other_val
+    # Nested dictionaries are merged via an explicit stack rather than recursion
+    stack = [(d, other)]
+    while stack:
+        d, other = stack.pop()
+        get = d.get
+        for other_key, other_val in other.items():
+            val = get(other_key)
+            if type(val) is dict and type(other_val) is dict:
+                stack.append((val, other_val))
+            elif replace or (other_key not in d):
+                d[other_key] = other_val
+
+
+def handle_inherit_directive(data, bases, subs, args, level, origin=None):
+    """
+    Handle the '$$inherit' directive (along with '$$keep' and '$$exclude') of a single dictionary.
+
+    The inherited data is fully processed and deep merged into the dictionary,
+    which is modified in place.
+
+    Parameters
+    ----------
+    data : dict
+        The dictionary with the '$$inherit' directive.
+    bases : dict
+        A dictionary containing information about the base paths to use when
+        converting the reference to a source path. Must contain the keys "id",
+        "self", and "dir".
+    subs: Substitutions
+        substitutions to make in strings, or None.
+    args: dict or dict-like (e.g., argument parse object)
+        additional settings affecting processing
+    level: int
+        nesting level of the dictionary.
+    """
+    if not isinstance(data['$$inherit'], list):
+        inherits = [data['$$inherit']]
+    else:
+        inherits = data['$$inherit']
+
+    # The data from all inherits is merged before $$keep and $$exclude are applied to it
+    inherited = {}
+
+    for inherit in inherits:
+
+        logging.debug("Handling $$inherit preprocessor directive: %s",inherit)
+
+        output = handle_inherit(inherit, args.inherit_mode, bases, subs, args, origin=origin)
+        if isinstance(output, dict):
+            # Handle the inherit recursively
+            newbases = bases.copy()
+            source = inherit_to_source(inherit, bases['self'], args.resolve_path, supported_input_formats)
+            newbases['self'] = os.path.dirname(source)
+            output = handle_all(output, newbases, subs, args, level=level+1, origin=source)
+
+            if not args.dont_clean_inner_schemas:
+                if '$schema' in output:
+                    del output['$schema']
+                if '$$schema' in output:
+                    del output['$$schema']
+
+        merge_deep(inherited, output, replace=False)
+
+    if '$$keep' in data:
+        logging.debug("Handling $$keep preprocessor directive: %s",data['$$keep'])
+        for key in list(inherited.keys()):
+            if key not in data['$$keep']:
+                del inherited[key]
+        del data['$$keep']
+
+    if '$$exclude' in data:
+        logging.debug("Handling $$exclude preprocessor directive: %s",data['$$exclude'])
+        for item in data['$$exclude']:
+            pointer = exclude_pointer_re.split(item)
+            loc = inherited
+            while len(pointer) > 1:
+                key = pointer.pop(0)
+                if key in loc:
+                    loc = loc[key]
+                else:
+                    raise Exception("$$exclude path pointer invalid:",item)
+            del loc[pointer[0]]
+        del data['$$exclude']
+
+    merge_deep(data, inherited, replace=False)
+    del data['$$inherit']
 
 
 def handle_all(data, bases, subs, args, level, origin=None):
     """
-    Recursively handles all '$$inherit' references and perform substitutions in the input data.
+    Handles all '$$inherit' references and other processing of the input data.
+
+    The data is modified in place. It is traversed with an explicit stack rather
+    than recursion, which avoids a Python call per nested dict or list and
+    recursion depth limits on deeply nested input. Only inherited data is
+    processed with a nested call.
 
     Parameters
     ----------
@@ -1227,8 +1536,8 @@ def handle_all(data, bases, subs, args, level, origin=None):
         converting the reference to a source path. Must contain the keys "id",
         "self", and "dir". If not provided, the current working directory will
         be used as the base path.
-    subs: dict
-        dictionary of substitutions to make in strings.
+    subs: Substitutions
+        substitutions to make in strings, or None.
     args: dict or dict-like (e.g., argument parse object)
         additional settings affecting processing
     level: int, optional
@@ -1240,82 +1549,69 @@ def handle_all(data, bases, subs, args, level, origin=None):
         The input data with '$$inherit' references handled according to the specified mode.
     """
 
-    logging.debug("Handling: %s",data)
+    # Parsed JSON/YAML only contains plain dicts and lists, so exact type checks
+    # are enough and cheaper than isinstance
+    if type(data) is not dict and type(data) is not list:
+        raise Exception("handle: unknown data type, not dict or list: %s",type(data))
 
-    if isinstance(data, list):
-        for i in range(len(data)):
-            if isinstance(data[i], dict) or isinstance(data[i], list):
-                data[i] = handle_all(data[i], bases, subs, args, level=level+1, origin=origin)
-        return data
+    # Settings and functions used for every node are bound to local names once
+    remove_null = args.remove_null
+    max_len = intern_max_len
+    intern = sys.intern
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-    elif isinstance(data, dict):
+    stack = [(data, level)]
 
-        if '$$inherit' in data:
+    while stack:
 
-            if not isinstance(data['$$inherit'], list):
-                inherits = [data['$$inherit']]
-            else:
-                inherits = data['$$inherit']
-
-            for inherit in inherits:
-
-                logging.debug("Handling $$inherit preprocessor directive: %s",inherit)
-
-                output = handle_inherit(inherit, args.inherit_mode, bases, subs, args, origin=origin)
-                if isinstance(output, dict):
-                    # Handle the inherit recursively
-                    newbases = bases.copy()
-                    source = inherit_to_source(inherit, bases['self'], args.resolve_path, supported_input_formats)
-                    newbases['self'] = os.path.dirname(source)
-                    output = handle_all(output, newbases, subs, args, level=level+1, origin=source)
-
-                    if not args.dont_clean_inner_schemas:
-                        if '$schema' in output:
-                            del output['$schema']
-                        if '$$schema' in output:
-                            del output['$$schema']
-
-            if '$$keep' in data:
-                logging.debug("Handling $$keep preprocessor directive: %s",data['$$keep'])
-                for key in list(output.keys()):
-                    if key not in data['$$keep']:
-                        del output[key]
-                del data['$$keep']
-
-            if '$$exclude' in data:
-                logging.debug("Handling $$exclude preprocessor directive: %s",data['$$exclude'])
-                for item in data['$$exclude']:
-                    pointer = re.split(r'(?<!\\)/', item)
-                    loc = output
-                    while len(pointer) > 1:
-                        key = pointer.pop(0)
-                        if key in loc:
-                            loc = loc[key]
-                        else:
-                            raise Exception("$$exclude path pointer invalid:",item)
-                    del loc[pointer[0]]
-                del data['$$exclude']
-
-            merge_deep(data, output, replace=False)
-            del data['$$inherit']
-
-        for k, v in list(data.items()):
-            if isinstance(v, dict) or isinstance(v, list):
-                data[k] = handle_all(v, bases, subs, args, level=level+1, origin=origin)
-            if args.remove_null and v is None:
-                del data[k]
-
-        # Always place $schema and $id at the top of the output for ordered output
-        if isinstance(data,OrderedDict):
-            if '$id' in data:
-                data.move_to_end('$id',last=False)
-            if '$schema' in data:
-                data.move_to_end('$schema',last=False)
-
-        return data
+        node, node_level = stack.pop()
 
-    else:
-        raise Exception("handle: unknown data type, not dict or list: %s",type(data))
+        if debug:
+            logging.debug("Handling: %s",node)
+
+        if type(node) is list:
+            children = []
+            for i, v in enumerate(node):
+                v_type = type(v)
+                if v_type is dict or v_type is list:
+                    children.append((v, node_level+1))
+                elif v_type is str and len(v) <= max_len:
+                    node[i] = intern(v)
+            # Children are pushed in reverse to be handled in order
+            stack.extend(reversed(children))
+            continue
+
+        if '$$inherit' in node:
+            handle_inherit_directive(node, bases, subs, args, node_level, origin=origin)
+
+        children = []
+        # Null values are deleted after the loop, so no copy of the items is needed to iterate
+        # (replacing the values of existing keys during iteration is fine)
+        to_delete = []
+        for k, v in node.items():
+            v_type = type(v)
+            if v_type is dict or v_type is list:
+                children.append((v, node_level+1))
+            elif v_type is str and len(v) <= max_len:
+                node[k] = intern(v)
+            elif remove_null and v is None:
+                to_delete.append(k)
+        for k in to_delete:
+            del node[k]
+        stack.extend(reversed(children))
+
+        # Always place $schema and $id at the top of the output (the dict is
+        # only rebuilt if they are not already there, which is the common case)
+        if '$id' in node or '$schema' in node:
+            top_keys = [k for k in ('$schema', '$id') if k in node]
+            if list(itertools.islice(node, len(top_keys))) != top_keys:
+                top = {k: node.pop(k) for k in top_keys}
+                rest = node.copy()
+                node.clear()
+                node.update(top)
+                node.update(rest)
+
+    return data
 
 
 def process(source, bases, subs, args):
@@ -1330,8 +1626,8 @@ def process(source, bases, subs, args):
         A dictionary containing information about the base paths to use when converting references
         to source paths. Must contain the keys "id" and "dir". If not provided, the current working
         directory will be used as the base path.
-    subs: dict
-        dictionary of substitutions to make in strings.
+    subs: Substitutions
+        substitutions to make in strings, or None.
     args: dict or dict-like (e.g., argument parse object)
         additional settings affecting processing
 
@@ -1347,6 +1643,7 @@ def process(source, bases, subs, args):
 
     # First handle all replacements
     if subs is not None:
+        logging.debug("Substituting strings: %s", subs)
         recursive_replace(data, subs)
 
     # Inheriting the top $id is interpreted as a special case that needs to be
@@ -1368,7 +1665,7 @@ def process(source, bases, subs, args):
                 rel_source, ext = os.path.splitext(rel_source)
                 if not id_uri.endswith(rel_source):
                     raise Exception("The $id field needs to end with: "+str(rel_source)+" but it does not: "+str(id_uri))
-            bases = {'id': id_uri[:-len(rel_source)], 'dir': bases['dir'] }
+            bases = dict(bases, id=id_uri[:-len(rel_source)])
 
     data = handle_all(data, bases, subs, args, level=0, origin=source)
 
@@ -1387,8 +1684,8 @@ def process_dir(source_dir, bases, subs, args):
         A dictionary containing information about the base paths to use when converting references
         to source paths. Must contain the keys "id" and "dir". If not provided, the current working
         directory will be used as the base path.
-    subs: dict
-        dictionary of substitutions to make in strings.
+    subs: Substitutions
+        substitutions to make in strings, or None.
     args: dict or dict-like (e.g., argument parse object)
         additional settings affecting processing
 
@@ -1399,25 +1696,107 @@ def process_dir(source_dir, bases, subs, args):
         subdirectories, where the keys are the file names and the values are the processed data.
     """
 
-    alldata = OrderedDict()
-
-    for filename in os.listdir(source_dir):
-        f = os.path.join(source_dir,filename)
-        if os.path.isfile(f):
-            base, ext = os.path.splitext(f)
-            if ext[1:] in supported_input_formats:
+    layout = list_dir(source_dir)
+
+    files = []
+    def collect_files(layout):
+        dir_files, subdirs = layout
+        files.extend(f for name, f in dir_files)
+        for name, sublayout in subdirs:
+            collect_files(sublayout)
+    collect_files(layout)
+
+    # The files are processed independently, each with its own copy of bases
+    jobs = args.jobs if args.jobs != 0 else (os.cpu_count() or 1)
+    if jobs > 1 and len(files) > 1:
+        log_level = logging.getLogger().getEffectiveLevel()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(files)), initializer=process_dir_worker_init,
+                                                    initargs=(log_level, ExceptionWrapper.debug)) as executor:
+            futures = {}
+            for f in files:
                 logging.info("Process dir reads file: %s",f)
-                data = process(f, bases, subs, args)
-                #alldata.update(data)
-                alldata[os.path.basename(base)] = data
-    for filename in os.listdir(source_dir):
-        f = os.path.join(source_dir,filename)
-        if os.path.isdir(f):
-            logging.info("Process dir reads directory: %s",f)
-            dirdata = process_dir(f, bases, subs, args)
-            alldata[os.path.basename(f)] = dirdata
+                futures[f] = executor.submit(process_dir_file, f, bases.copy(), subs, args)
+            try:
+                # Collect in submission order so that errors are reported for the first failing file
+                results = {f: futures[f].result() for f in files}
+            except BaseException:
+                for future in futures.values():
+                    future.cancel()
+                raise
+    else:
+        results = {}
+        for f in files:
+            logging.info("Process dir reads file: %s",f)
+            results[f] = process(f, bases.copy(), subs, args)
+
+    def assemble(layout):
+        dir_files, subdirs = layout
+        alldata = {}
+        for name, f in dir_files:
+            alldata[name] = results[f]
+        for name, sublayout in subdirs:
+            alldata[name] = assemble(sublayout)
+        return alldata
+
+    return assemble(layout)
+
+
+def process_dir_file(source, bases, subs, args):
+    """
+    Process a single file in a process_dir worker process.
+
+    Errors are wrapped in the worker, so that the reported location is where
+    the error happened rather than where the result is collected.
+    """
+    try:
+        return process(source, bases, subs, args)
+    except Exception as e:
+        raise ExceptionWrapper("Processing of file "+source+" failed", e) from e
 
-    return alldata
+
+def process_dir_worker_init(log_level, debug):
+    """
+    Set up logging and error reporting in a process_dir worker process.
+    """
+    logging.basicConfig(format='%(levelname)s: %(message)s',level=log_level)
+    ExceptionWrapper.debug = debug
+
+
+def list_dir(source_dir):
+    """
+    Recursively lists the input files in a directory and its subdirectories.
+
+    Parameters
+    ----------
+    source_dir : str
+        The path to the directory to list.
+
+    Returns
+    -------
+    tuple
+        A tuple (files, subdirs), where files is a list of (name, path) pairs for the
+        files with a supported input format, and subdirs is a list of (name, layout)
+        pairs, where layout is the tuple returned by this function for the subdirectory.
+    """
+    files = []
+    dirs = []
+
+    # The file type information of scandir entries usually comes without an extra stat call
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                base, ext = os.path.splitext(entry.name)
+                if ext in supported_input_exts:
+                    files += [(base, os.path.join(source_dir,entry.name))]
+            elif entry.is_dir():
+                dirs += [os.path.join(source_dir,entry.name)]
+
+    subdirs = []
+    for f in dirs:
+        logging.info("Process dir reads directory: %s",f)
+        subdirs += [(os.path.basename(f), list_dir(f))]
+
+    return files, subdirs
 
 
 def main():
@@ -1435,7 +1814,7 @@ def main():
         bases = {'id':args.baseid, 'dir':args.basedir }
         if args.basedir is not None:
             args.resolve_path = [ args.basedir ] + args.resolve_path
-        subs = dict(args.sub) if len(args.sub) > 0 else None
+        subs = Substitutions(dict(args.sub)) if len(args.sub) > 0 else None
 
         # Make sure verbosity is in the allowed range
         log_levels = [logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
@@ -1476,8 +1855,8 @@ def main():
 
         try:
             if args.force_schema:
-                schema_data, ext = read_data(args.force_schema, "json")
-                validate(data, args, bases=bases, source=args.source, schema=args.force_schema)
+                schema_data, ext = read_data(args.force_schema[0], "json")
+                validate(data, args, bases=bases, source=args.source, schema=schema_data)
 
             if args.schema is not None and ('$schema' in data or '$$schema' in data):
                 schemas = {}
@@ -1494,21 +1873,25 @@ def main():
 
         try:
             logging.info("Serializing data into format: %s", args.output_format)
-            outstr = output_str(data, args.output_format, args)
-        except Exception as e:
-            raise ExceptionWrapper("Serialization of data failed", e) from e
-
-        try:
             if args.output:
                 logging.info("Writing serialized output to file: %s", args.output)
                 with open(args.output, "w") as f:
-                    f.write(outstr)
+                    try:
+                        write_output(data, args.output_format, args, f)
+                    except Exception:
+                        # Do not leave partially written output behind, e.g., for make to pick up
+                        f.close()
+                        os.remove(args.output)
+                        raise
             else:
                 logging.info("Writing serialized output to stdout")
-                print(outstr)
+                write_output(data, args.output_format, args, sys.stdout)
+                if args.output_format != "yaml":
+                    # Unlike the other formats, YAML output already ends with a newline
+                    print()
 
-        except Exeption as e:
-            raise ExceptionWrapper("Writing output data failed", e) from e
+        except Exception as e:
+            raise ExceptionWrapper("Serialization and writing of output data failed", e) from e
 
     except Exception as e:
         if debug: